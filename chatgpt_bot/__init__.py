@@ -1,12 +1,393 @@
 """A small library that helps you to create ChatGPT bots."""
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from datetime import timezone
 from typing import Any
+from typing import AsyncIterator
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+from typing import Union
 
-from openai import OpenAI
+if TYPE_CHECKING:  # pragma: no cover
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+def _reject(obj: Any) -> Any:
+    """Make orjson give up on anything it doesn't serialize the way json does."""
+    raise TypeError
+
+
+def _dump_metadata(metadata: Any) -> Union[bytes, str]:
+    """
+    Serialize metadata to JSON, with orjson if it's installed.
+
+    orjson output is returned as bytes. Whatever orjson would serialize differently
+    from json (non-string keys, integers over 64 bits, NaN and infinity, which it
+    writes as null, and datetimes, dataclasses and subclasses of builtins, which json
+    rejects or treats differently) is serialized with json instead, and returned as
+    text, so `_load_metadata` knows to read it back with json too. The exceptions are
+    UUIDs and enums, which orjson always serializes, and json rejects.
+    """
+    if orjson:
+        try:
+            data = orjson.dumps(
+                metadata,
+                default=_reject,
+                option=orjson.OPT_PASSTHROUGH_DATETIME
+                | orjson.OPT_PASSTHROUGH_DATACLASS
+                | orjson.OPT_PASSTHROUGH_SUBCLASS,
+            )
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            # Any nulls might have been NaN or infinity, so let json decide.
+            if b"null" not in data:
+                return data
+    return json.dumps(metadata)
+
+
+def _load_metadata(metadata: Union[bytes, str]) -> Any:
+    """Deserialize metadata, using orjson for what orjson wrote."""
+    if orjson and isinstance(metadata, bytes):
+        return orjson.loads(metadata)
+    return json.loads(metadata)
+
+
+def _to_payload(role: str, message: str) -> List[Dict[str, Any]]:
+    """
+    Convert a stored message to the messages GPT expects.
+
+    Recorded function calls (see `record_tool_calls`) are stored as a single
+    "assistant_tool" message, but the API needs them as an assistant message with the
+    calls, followed by a result for each call. We don't know the results, so we just
+    say that the call went fine.
+    """
+    if role != "assistant_tool":
+        return [{"role": role, "content": message}]
+
+    calls = json.loads(message)
+    payload: List[Dict[str, Any]] = [
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {
+                        "name": call["name"],
+                        "arguments": json.dumps(call["arguments"]),
+                    },
+                }
+                for call in calls
+            ],
+        }
+    ]
+    payload.extend(
+        {"role": "tool", "tool_call_id": call["id"], "content": "Ok, done."}
+        for call in calls
+    )
+    return payload
+
+
+# Bump this, and add a step to `_Database._migrate()`, whenever the schema changes.
+_SCHEMA_VERSION = 1
+
+# All the statements that run after setup, kept constant so that their prepared
+# versions stay in each connection's statement cache.
+_SQL_INSERT_MESSAGE = """
+INSERT INTO "Message" (timestamp, conversation_id, role, message)
+VALUES (?, ?, ?, ?)
+"""
+# Messages of the same turn share a timestamp, so break ties by insertion order. A
+# negative LIMIT means no limit.
+_SQL_SELECT_HISTORY = """
+SELECT role, message FROM "Message" WHERE conversation_id=?
+ORDER BY timestamp DESC, id DESC LIMIT ?
+"""
+_SQL_SELECT_UNSUMMARIZED_HISTORY = """
+SELECT role, message FROM "Message" WHERE conversation_id=? AND id > ?
+ORDER BY timestamp DESC, id DESC LIMIT ?
+"""
+_SQL_SELECT_RECENT_HISTORY = """
+SELECT role, message FROM "Message" WHERE conversation_id=?
+AND timestamp >= datetime('now', ?)
+ORDER BY timestamp DESC, id DESC LIMIT ?
+"""
+_SQL_GET_LAST_MESSAGE_ID = """
+SELECT MAX(id) FROM "Message"
+"""
+# The unary + keeps SQLite from using the conversation index, so that only the
+# messages added after the given ID are scanned.
+_SQL_GET_NEWER_MESSAGE = """
+SELECT 1 FROM "Message" WHERE id > ? AND +conversation_id=? LIMIT 1
+"""
+_SQL_LAST_INSERT_ID = """
+SELECT last_insert_rowid()
+"""
+_SQL_SELECT_MESSAGES_AFTER = """
+SELECT id, role, message FROM "Message" WHERE conversation_id=? AND id > ?
+ORDER BY timestamp, id
+"""
+_SQL_COUNT_MESSAGES_AFTER = """
+SELECT COUNT(*) FROM "Message" WHERE conversation_id=? AND id > ?
+"""
+_SQL_GET_SUMMARY = """
+SELECT summary, message_id FROM "Summary" WHERE conversation_id=?
+"""
+_SQL_UPSERT_SUMMARY = """
+INSERT INTO "Summary" (conversation_id, summary, message_id) VALUES (?, ?, ?)
+ON CONFLICT(conversation_id) DO UPDATE SET
+    summary = excluded.summary,
+    message_id = excluded.message_id
+"""
+_SQL_GET_CACHED_REPLY = """
+SELECT reply FROM "Cache" WHERE key=? AND created_at >= datetime('now', ?)
+"""
+_SQL_CACHE_REPLY = """
+INSERT OR REPLACE INTO "Cache" (key, reply, created_at) VALUES (?, ?, datetime('now'))
+"""
+_SQL_PRUNE_CACHE = """
+DELETE FROM "Cache" WHERE created_at < datetime('now', ?)
+"""
+_SQL_GET_METADATA = """
+SELECT id, metadata FROM "Metadata" WHERE conversation_id=?
+"""
+_SQL_UPSERT_METADATA = """
+INSERT INTO "Metadata" (conversation_id, metadata) VALUES (?, ?)
+ON CONFLICT(conversation_id) DO UPDATE SET
+    metadata = excluded.metadata
+"""
+
+
+class _Database:
+    """
+    A SQLite database with a single writer connection and a pool of readers.
+
+    In WAL mode, readers don't block the writer (or each other), so giving each
+    concurrent read its own connection lets them run in parallel with writes.
+
+    Conversations get their database from `acquire()`, so that all the ones in a
+    process that use the same file share its connections.
+    """
+
+    _shared: Dict[str, "_Database"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, filename: str, readers: int = 4):
+        self._filename = filename
+        # Every connection to ":memory:" is a separate database, so the readers would
+        # see an empty one. In that case, read through the writer instead.
+        self._in_memory = filename == ":memory:"
+        self._key: Optional[str] = None
+        self._users = 0
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        # Guards returning readers to the pool against closing it.
+        self._pool_lock = threading.Lock()
+        self._reader_slots = threading.BoundedSemaphore(readers)
+        self._migrate()
+
+    @classmethod
+    def acquire(cls, filename: str) -> "_Database":
+        """Return the database in `filename`, and `release()` it when you're done."""
+        if filename == ":memory:":
+            # Every in-memory database is a different one.
+            return cls(filename)
+
+        key = os.path.abspath(filename)
+        with cls._shared_lock:
+            database = cls._shared.get(key)
+            if database is None:
+                database = cls._shared[key] = cls(filename)
+                database._key = key
+            database._users += 1
+        return database
+
+    def release(self) -> None:
+        """Stop using the database, and close it if nobody else is."""
+        if self._key is not None:
+            with self._shared_lock:
+                self._users -= 1
+                if self._users:
+                    return
+                del self._shared[self._key]
+        self.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open and configure a new connection."""
+        # We manage transactions ourselves, so connections are in autocommit mode,
+        # and they're used by the worker threads `ask()` runs queries in.
+        con = sqlite3.connect(
+            self._filename,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        con.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-65536;
+            PRAGMA busy_timeout=5000;
+            PRAGMA foreign_keys=ON;
+            """
+        )
+        return con
+
+    def _migrate(self) -> None:
+        """
+        Bring the schema up to date.
+
+        The schema version is stored in `PRAGMA user_version`, so that opening an
+        up-to-date database costs a single pragma read rather than a round of DDL.
+        """
+        version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return
+
+        with self.write() as con:
+            # Another connection might have migrated while we were waiting for the lock.
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                # Databases from before we kept a version might already have some of
+                # these, hence the IF NOT EXISTS.
+                con.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS "Message" (
+                  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                  "timestamp" DATETIME NOT NULL,
+                  "conversation_id" TEXT NOT NULL,
+                  "role" TEXT NOT NULL,
+                  "message" TEXT NOT NULL
+                )
+                """
+                )
+
+                con.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS "Metadata" (
+                  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+                  "conversation_id" TEXT NOT NULL UNIQUE,
+                  "metadata" BLOB NOT NULL
+                )
+                """
+                )
+
+                con.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS "Summary" (
+                  "conversation_id" TEXT PRIMARY KEY,
+                  "summary" TEXT NOT NULL,
+                  "message_id" INTEGER NOT NULL
+                )
+                """
+                )
+
+                con.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS "Cache" (
+                  "key" TEXT PRIMARY KEY,
+                  "reply" TEXT NOT NULL,
+                  "created_at" DATETIME NOT NULL
+                )
+                """
+                )
+
+                # This index lets SQLite walk a conversation's history backwards for
+                # `ORDER BY timestamp DESC LIMIT n` without sorting, and makes the old
+                # conversation_id-only index redundant.
+                con.execute(
+                    """
+                CREATE INDEX IF NOT EXISTS "idx_message__conversation_id_timestamp" ON "Message" ("conversation_id", "timestamp");
+                """
+                )
+                con.execute('DROP INDEX IF EXISTS "idx_message__conversation_id"')
+                # The UNIQUE constraint on conversation_id already indexes it.
+                con.execute('DROP INDEX IF EXISTS "idx_metadata__conversation_id"')
+                # Lets us prune expired replies without scanning the whole cache.
+                con.execute(
+                    """
+                CREATE INDEX IF NOT EXISTS "idx_cache__created_at" ON "Cache" ("created_at");
+                """
+                )
+                con.execute('ANALYZE "Message"')
+
+            con.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+
+    @contextlib.contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """
+        Run the enclosed statements in a single write transaction.
+
+        We use `BEGIN IMMEDIATE` so that the write lock is taken upfront, rather than
+        trying to upgrade a read lock later and failing with SQLITE_BUSY.
+        """
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+    @contextlib.contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """Borrow one of the reader connections."""
+        if self._in_memory:
+            with self._write_lock:
+                yield self._writer
+            return
+
+        with self._reader_slots:
+            try:
+                con = self._readers.get_nowait()
+            except queue.Empty:
+                con = self._connect()
+            try:
+                yield con
+            finally:
+                with self._pool_lock:
+                    if self._closed:
+                        con.close()
+                    else:
+                        self._readers.put(con)
+
+    def close(self) -> None:
+        """Close all the connections, and any readers as they're returned."""
+        with self._write_lock:
+            self._writer.close()
+        with self._pool_lock:
+            self._closed = True
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
 
 
 class Conversation:
@@ -21,6 +402,11 @@ class Conversation:
         model: str = "gpt-3.5-turbo",
         message_limit: Optional[int] = None,
         time_limit: Optional[int] = None,
+        summarize: bool = False,
+        cache_replies: bool = False,
+        cache_ttl: int = 24,
+        token_limit: Optional[int] = None,
+        record_tool_calls: bool = False,
     ):
         """
         Initialize the class.
@@ -28,137 +414,422 @@ class Conversation:
         conversation_id - A random conversation ID (whatever you want).
         api_key - Your OpenAI API key.
         system_prompt - The ChatGPT system prompt you want to use.
-        database_filename - Where you want to save the database."
+        database_filename - Where you want to save the database. The database runs
+            in WAL mode, so `-wal` and `-shm` files will appear next to it. Several
+            instances (and processes) can share a database, and even a conversation.
         model - The ChatGPT model version to use.
         message_limit - The number of messages to retrieve from history every time.
         time_limit - Only send GPT previous messages exchanged within `time_limit` hours.
+        summarize - Keep a running summary of the messages that fall outside
+            `message_limit`, and send it to GPT along with the history. To save API
+            calls, messages are summarized in batches of `message_limit`, and they
+            stay in the history until they are, so the history can grow to three
+            times `message_limit`.
+        cache_replies - Reuse the reply to an identical request in this conversation
+            (same model, prompts, history and question) instead of asking GPT again.
+        cache_ttl - How many hours cached replies are reused for.
+        token_limit - Drop the oldest messages from history so that the prompt stays
+            under roughly this many tokens. Requires the `tiktoken` extra.
+        record_tool_calls - Store the functions GPT called and their arguments in the
+            history, so it knows what it did in later turns. Otherwise, only the
+            question is stored for those turns, which costs far fewer tokens.
         """
-        self._openai = OpenAI(api_key=api_key)
+        self._api_key = api_key
         self._conversation_id = conversation_id
         self._system_prompt = system_prompt
         self._message_limit = message_limit
         self._time_limit = time_limit
         self._model = model
-        self._con = sqlite3.connect(database_filename)
-        self._cur = self._con.cursor()
+        self._summarize = summarize and bool(message_limit)
+        self._cache_replies = cache_replies
+        self._cache_ttl = f"-{int(cache_ttl)} hours"
+        self._token_limit = token_limit
+        self._record_tool_calls = record_tool_calls
+        self._summary_task: Optional[asyncio.Task] = None
+        # After a failure, we wait until there are this many unsummarized messages
+        # before trying again.
+        self._summary_retry_at = 0
+        self._summary_failures = 0
+        self._summary_message: Optional[Dict[str, Any]] = None
+        # The number of messages that aren't in the summary.
+        self._unsummarized = 0
+        self._system_message = {"role": "system", "content": system_prompt}
+        # The history we send to the API, kept in memory and appended to every turn so
+        # that the payload stays identical and the provider's prompt cache can hit.
+        # Every stored message is a group of API messages (see `_to_payload()`).
+        # It's loaded from the database on the first turn (unless there's a time limit),
+        # and reloaded if anyone else adds to the conversation.
+        self._chat_cache: Optional[List[List[Dict[str, Any]]]] = None
+        # The ID of the newest message that `_chat_cache` is known to be up to date
+        # with.
+        self._seen_id = 0
+        # The token count of every message in `_chat_cache`, filled in when needed.
+        self._token_counts: List[Optional[int]] = []
 
-        self._cur.execute(
-            """
-        CREATE TABLE IF NOT EXISTS "Message" (
-          "id" INTEGER PRIMARY KEY AUTOINCREMENT,
-          "timestamp" DATETIME NOT NULL,
-          "conversation_id" TEXT NOT NULL,
-          "role" TEXT NOT NULL,
-          "message" TEXT NOT NULL
-        )
+        # Leave room for the new message, which isn't in the database yet.
+        limit = message_limit - 1 if message_limit else -1
+        if time_limit:
+            self._select_history_stmt = _SQL_SELECT_RECENT_HISTORY
+            self._select_history_params: Tuple[Any, ...] = (
+                conversation_id,
+                f"-{int(time_limit)} hours",
+                limit,
+            )
+        elif self._summarize:
+            assert message_limit
+            # Evicted messages stay in the history until they're summarized, so
+            # leave room for two more batches (see `_end_turn()`). The ID of the last
+            # summarized message is set by `_set_summary()`.
+            limit = 3 * message_limit - 1
+            self._select_history_stmt = _SQL_SELECT_UNSUMMARIZED_HISTORY
+            self._select_history_params = (conversation_id, 0, limit)
+        else:
+            self._select_history_stmt = _SQL_SELECT_HISTORY
+            self._select_history_params = (conversation_id, limit)
+        self._history_limit = limit
+
+        self._db = _Database.acquire(database_filename)
+
+        if self._summarize:
+            summary, message_id = self._get_summary()
+            self._set_summary(summary, message_id)
+            with self._db.read() as con:
+                self._unsummarized = con.execute(
+                    _SQL_COUNT_MESSAGES_AFTER, (conversation_id, message_id)
+                ).fetchone()[0]
+
+    @functools.cached_property
+    def _openai(self) -> "AsyncOpenAI":
         """
-        )
+        Create the OpenAI client.
 
-        self._cur.execute(
-            """
-        CREATE TABLE IF NOT EXISTS "Metadata" (
-          "id" INTEGER PRIMARY KEY AUTOINCREMENT,
-          "conversation_id" TEXT NOT NULL UNIQUE,
-          "metadata" BLOB NOT NULL
-        )
+        The openai library is slow to import, so we only do it the first time we need
+        to talk to GPT, rather than for users who only read history or metadata.
         """
-        )
+        from openai import AsyncOpenAI
 
-        self._cur.execute(
-            """
-        CREATE INDEX IF NOT EXISTS "idx_message__conversation_id" ON "Message" ("conversation_id");
+        return AsyncOpenAI(api_key=self._api_key)
+
+    @functools.cached_property
+    def _count_tokens(self) -> Callable[[str], int]:
+        """Return a function that counts the tokens in a text, for our model."""
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(self._model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        # Users can type special tokens like "<|endoftext|>", which `encode()` rejects,
+        # but to the API they're just text.
+        return lambda text: len(encoding.encode_ordinary(text))
+
+    def _count_message_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """Roughly count the tokens that some API messages will cost."""
+        total = 0
+        for message in messages:
+            # Each message costs a few tokens more than its content.
+            total += self._count_tokens(message.get("content") or "") + 4
+            if "tool_calls" in message:
+                total += self._count_tokens(json.dumps(message["tool_calls"]))
+        return total
+
+    def _fit_history(
+        self,
+        history: List[List[Dict[str, Any]]],
+        counts: List[Optional[int]],
+        budget: int,
+    ) -> int:
         """
-        )
-        self._cur.execute(
-            """
-        CREATE INDEX IF NOT EXISTS "idx_metadata__conversation_id" ON "Metadata" ("conversation_id");
+        Return the index of the oldest message in `history` that fits in `budget`.
+
+        Messages are counted from the newest backwards, stopping as soon as the budget
+        runs out, so older ones are never encoded. `counts` holds each message's token
+        count (or None, if it hasn't been counted yet), and is filled in as we go.
         """
+        total = 0
+        for index in range(len(history) - 1, -1, -1):
+            count = counts[index]
+            if count is None:
+                count = counts[index] = self._count_message_tokens(history[index])
+            total += count
+            if total > budget:
+                return index + 1
+        return 0
+
+    def add_messages(self, messages: Iterable[Tuple[str, str]]) -> None:
+        """
+        Add a batch of `(role, message)` pairs to the database.
+
+        All the messages are written in a single transaction, which makes this much
+        faster than adding them one by one (e.g. when importing a conversation).
+        """
+        messages = list(messages)
+        seen_id = self._seen_id if self._chat_cache is not None else None
+        with self._db.write() as con:
+            last_id, up_to_date = self._insert_messages(con, messages, seen_id)
+        self._remember_messages(messages, last_id, up_to_date)
+
+    def _insert_messages(
+        self,
+        con: sqlite3.Connection,
+        messages: List[Tuple[str, str]],
+        seen_id: Optional[int],
+    ) -> Tuple[int, bool]:
+        """
+        Insert messages as part of a write transaction.
+
+        Return the ID of the last inserted message, and whether the in-memory history
+        was up to date before them, i.e. whether nobody else has added to the
+        conversation since `seen_id` (if it's None, we don't check).
+        """
+        up_to_date = (
+            seen_id is not None
+            and not con.execute(
+                _SQL_GET_NEWER_MESSAGE, (seen_id, self._conversation_id)
+            ).fetchone()
+        )
+        # The same format as SQLite's datetime(), so we can compare them.
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        con.executemany(
+            _SQL_INSERT_MESSAGE,
+            [
+                (timestamp, self._conversation_id, role, message)
+                for role, message in messages
+            ],
         )
-        self._con.commit()
+        return con.execute(_SQL_LAST_INSERT_ID).fetchone()[0], up_to_date
 
-    def _add_message(self, message: str, user: bool) -> None:
-        """Add a message to the database."""
-        self._cur.execute(
-            """
-        INSERT INTO "Message"
-        (timestamp, conversation_id, role, message)
-        VALUES
-        (datetime(strftime('%s', 'now'), 'unixepoch'), ?, ?, ?);""",
-            (self._conversation_id, "user" if user else "assistant", message),
+    def _remember_messages(
+        self, messages: List[Tuple[str, str]], last_id: int, up_to_date: bool
+    ) -> None:
+        """
+        Add stored messages to the in-memory history.
+
+        `last_id` and `up_to_date` are what `_insert_messages()` returned.
+        `_build_chat()` reads the history on the event loop, so this must run there
+        too, rather than in the worker thread that stored the messages.
+        """
+        self._unsummarized += len(messages)
+        if self._chat_cache is None or last_id <= self._seen_id:
+            # There's no history yet, or it was (re)loaded after these were stored.
+            return
+        if not up_to_date:
+            # Someone else added to the conversation, so reload the history.
+            self._chat_cache = None
+            return
+        self._chat_cache.extend(
+            _to_payload(role, message) for role, message in messages
         )
+        self._token_counts.extend([None] * len(messages))
+        self._seen_id = last_id
+        if self._history_limit >= 0:
+            excess = len(self._chat_cache) - self._history_limit
+            if excess > 0:
+                del self._chat_cache[:excess]
+                del self._token_counts[:excess]
 
-        self._con.commit()
+    def _select_history(self, con: sqlite3.Connection) -> List[List[Dict[str, Any]]]:
+        """Select the history that precedes a new message, in the API's format."""
+        rows = con.execute(
+            self._select_history_stmt, self._select_history_params
+        ).fetchall()
+        return [_to_payload(role, message) for role, message in reversed(rows)]
 
-    def _get_messages(self) -> List[Dict[str, Any]]:
-        """Retrieve all messages from the database."""
-        query = [
-            """
-            SELECT id, timestamp, role, message FROM "Message" WHERE
-            conversation_id=?
-            """
-        ]
+    def _get_messages(self) -> List[List[Dict[str, Any]]]:
+        """Retrieve the history that precedes a new message, in the API's format."""
+        with self._db.read() as con:
+            return self._select_history(con)
 
-        if self._time_limit:
-            query.append(
-                f"AND timestamp >= datetime('now', '-{self._time_limit} hours')"
+    def _load_history(self) -> Tuple[int, List[List[Dict[str, Any]]]]:
+        """Retrieve the history, and the ID of the newest message in the database."""
+        with self._db.read() as con:
+            # Read both from the same snapshot, so the history has everything up to
+            # that ID.
+            con.execute("BEGIN")
+            try:
+                last_id = con.execute(_SQL_GET_LAST_MESSAGE_ID).fetchone()[0] or 0
+                return last_id, self._select_history(con)
+            finally:
+                con.execute("COMMIT")
+
+    def _check_history(self, seen_id: int) -> Tuple[int, bool]:
+        """
+        Check whether the in-memory history is still up to date.
+
+        Return the ID of the newest message in the database, and whether nobody else
+        has added to the conversation since `seen_id`.
+        """
+        with self._db.read() as con:
+            con.execute("BEGIN")
+            try:
+                last_id = con.execute(_SQL_GET_LAST_MESSAGE_ID).fetchone()[0] or 0
+                newer = con.execute(
+                    _SQL_GET_NEWER_MESSAGE, (seen_id, self._conversation_id)
+                ).fetchone()
+            finally:
+                con.execute("COMMIT")
+        return last_id, not newer
+
+    def _get_summary(self) -> Tuple[Optional[str], int]:
+        """Retrieve the summary, and the ID of the last message it covers."""
+        with self._db.read() as con:
+            row = con.execute(_SQL_GET_SUMMARY, (self._conversation_id,)).fetchone()
+        if not row:
+            return None, 0
+        return row[0], row[1]
+
+    def _set_summary(self, summary: Optional[str], message_id: int) -> None:
+        """
+        Set the summary of the conversation up to (and including) `message_id`.
+
+        This sets the message that introduces the summary to GPT, and leaves the
+        messages it covers out of the history.
+        """
+        if self._select_history_stmt is _SQL_SELECT_UNSUMMARIZED_HISTORY:
+            self._select_history_params = (
+                self._conversation_id,
+                message_id,
+                self._history_limit,
             )
+        if summary:
+            self._summary_message = {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {summary}",
+            }
+        else:
+            self._summary_message = None
 
-        query.append("ORDER BY timestamp DESC")
+    def _get_evicted_messages(self) -> Tuple[Optional[str], List[Tuple[int, str, str]]]:
+        """Retrieve the summary and the unsummarized messages outside the history."""
+        summary, message_id = self._get_summary()
+        with self._db.read() as con:
+            rows = con.execute(
+                _SQL_SELECT_MESSAGES_AFTER, (self._conversation_id, message_id)
+            ).fetchall()
+        # The last `message_limit - 1` messages are still sent as they are.
+        assert self._message_limit
+        return summary, rows[: max(0, len(rows) - (self._message_limit - 1))]
 
-        if self._message_limit:
-            query.append(f"LIMIT {self._message_limit}")
+    def _store_summary(self, summary: str, message_id: int) -> None:
+        """Store the summary of the conversation up to (and including) `message_id`."""
+        with self._db.write() as con:
+            con.execute(
+                _SQL_UPSERT_SUMMARY, (self._conversation_id, summary, message_id)
+            )
 
-        self._cur.execute(" ".join(query), (self._conversation_id,))
-        messages = [
-            {"id": x[0], "timestamp": x[1], "role": x[2], "message": x[3]}
-            for x in reversed(self._cur.fetchall())
-        ]
-        return messages
+    async def _update_summary(self) -> None:
+        """Fold the messages that fell out of the history into the summary."""
+        summary, evicted = await asyncio.to_thread(self._get_evicted_messages)
+        if not evicted:
+            return
+
+        lines = []
+        for _, role, message in evicted:
+            if role == "assistant_tool":
+                calls = ", ".join(
+                    f"{call['name']}({json.dumps(call['arguments'])})"
+                    for call in json.loads(message)
+                )
+                lines.append(f"assistant: (called {calls})")
+            else:
+                lines.append(f"{role}: {message}")
+        transcript = "\n".join(lines)
+        if summary:
+            transcript = f"Summary so far: {summary}\n\nNew messages:\n{transcript}"
+        completion = await self._openai.chat.completions.create(
+            model=self._model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize the following conversation in a few "
+                    "sentences, keeping any details that might be needed later.",
+                },
+                {"role": "user", "content": transcript},
+            ],
+        )
+        new_summary: str = (completion.choices[0].message.content or "").strip()
+        await asyncio.to_thread(self._store_summary, new_summary, evicted[-1][0])
+        self._set_summary(new_summary, evicted[-1][0])
+        self._unsummarized -= len(evicted)
+        # The payload changes anyway, so reload the history without the summarized
+        # messages.
+        self._chat_cache = None
+
+    def _summary_done(self, task: asyncio.Task) -> None:
+        """Log a failed summary, and back off before trying again."""
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            self._summary_failures = 0
+            self._summary_retry_at = 0
+            return
+        assert self._message_limit
+        # Wait for another batch of messages, twice as many after every consecutive
+        # failure.
+        self._summary_retry_at = self._unsummarized + self._message_limit * 2 ** min(
+            self._summary_failures, 5
+        )
+        self._summary_failures += 1
+        logger.warning(
+            "Couldn't summarize conversation %s.",
+            self._conversation_id,
+            exc_info=error,
+        )
+
+    def _get_cached_reply(self, key: str) -> Optional[Dict[str, Any]]:
+        """Retrieve a reply from the cache."""
+        with self._db.read() as con:
+            row = con.execute(_SQL_GET_CACHED_REPLY, (key, self._cache_ttl)).fetchone()
+        if not row:
+            return None
+        reply = json.loads(row[0])
+        if reply["type"] == "function":
+            # JSON turns our (name, arguments) tuples into lists.
+            reply["data"] = [tuple(call) for call in reply["data"]]
+        return reply
 
     def get_metadata(self) -> Any:
         """Retrieve the metadata for the current conversation."""
-        self._cur.execute(
-            """SELECT id, metadata FROM "Metadata" WHERE conversation_id=?""",
-            (self._conversation_id,),
-        )
-        metadata = self._cur.fetchone()
+        with self._db.read() as con:
+            metadata = con.execute(
+                _SQL_GET_METADATA, (self._conversation_id,)
+            ).fetchone()
         if not metadata:
             return None
-        return json.loads(metadata[1])
+        return _load_metadata(metadata[1])
 
     def set_metadata(self, metadata):
         """Store some metadata for the current conversation."""
-        self._cur.execute(
-            """
-            INSERT INTO Metadata (conversation_id, metadata)
-            VALUES (?, ?)
-            ON CONFLICT(conversation_id) DO UPDATE SET
-                metadata = excluded.metadata;
-            """,
-            (self._conversation_id, json.dumps(metadata)),
-        )
-        self._con.commit()
+        with self._db.write() as con:
+            con.execute(
+                _SQL_UPSERT_METADATA, (self._conversation_id, _dump_metadata(metadata))
+            )
 
-    def ask(self, message: str, functions=None) -> dict[str, Any]:
-        """Ask ChatGPT a question."""
-        chat = [{"role": "system", "content": self._system_prompt}]
-        self._add_message(message, user=True)
-        chat.extend(
-            [{"role": m["role"], "content": m["message"]} for m in self._get_messages()]
-        )
+    async def close(self) -> None:
+        """Close the OpenAI client, and the database unless others still use it."""
+        if self._summary_task:
+            # If summarizing failed, the messages will be summarized next time.
+            await asyncio.gather(self._summary_task, return_exceptions=True)
+        if "_openai" in self.__dict__:
+            await self._openai.close()
+        self._db.release()
 
+    async def _complete(self, chat: List[Dict[str, Any]], functions) -> Dict[str, Any]:
+        """Send the chat to GPT and parse its reply."""
         if functions:
-            completion = self._openai.chat.completions.create(
+            completion = await self._openai.chat.completions.create(
                 model=self._model, messages=chat, tools=functions
             )
         else:
-            completion = self._openai.chat.completions.create(
+            completion = await self._openai.chat.completions.create(
                 model=self._model, messages=chat
             )
 
-        finish_reason = completion.choices[0].finish_reason
-        if finish_reason == "tool_calls":
-            response_message = completion.choices[0].message
+        response_message = completion.choices[0].message
+        # When a function is forced with `tool_choice`, the finish reason is "stop",
+        # so go by whether there are any calls.
+        if response_message.tool_calls:
             function_calls = []
             for tool_call in response_message.tool_calls:
                 if tool_call.type != "function":
@@ -166,9 +837,196 @@ class Conversation:
                 function_calls.append(
                     (tool_call.function.name, json.loads(tool_call.function.arguments))
                 )
-            self._add_message("Ok, done.", user=False)
             return {"type": "function", "data": function_calls}
         else:
-            reply = completion.choices[0].message.content.strip()
-            self._add_message(reply, user=False)
+            reply = (response_message.content or "").strip()
             return {"type": "text", "data": reply}
+
+    async def _build_chat(self, message: str) -> List[Dict[str, Any]]:
+        """Build the payload for a new message: prompts, history and the message."""
+        chat: List[Dict[str, Any]] = [self._system_message]
+        if self._summary_message:
+            chat.append(self._summary_message)
+
+        history: List[List[Dict[str, Any]]]
+        if self._time_limit:
+            # Old messages expire as time passes, so the history can't be cached.
+            history = await asyncio.to_thread(self._get_messages)
+            counts: List[Optional[int]] = [None] * len(history)
+        else:
+            if self._chat_cache is not None:
+                last_id, up_to_date = await asyncio.to_thread(
+                    self._check_history, self._seen_id
+                )
+                if not up_to_date:
+                    self._chat_cache = None
+                elif self._chat_cache is not None:
+                    self._seen_id = max(self._seen_id, last_id)
+            if self._chat_cache is None:
+                last_id, history = await asyncio.to_thread(self._load_history)
+                # Another turn might have loaded it while we were waiting.
+                if self._chat_cache is None or last_id > self._seen_id:
+                    self._chat_cache = history
+                    self._token_counts = [None] * len(history)
+                    self._seen_id = last_id
+            history, counts = self._chat_cache, self._token_counts
+
+        # The question is only stored together with the reply, so that the whole turn
+        # costs a single transaction.
+        question = {"role": "user", "content": message}
+
+        start = 0
+        if self._token_limit:
+            # The prompts and the question are always sent, and the newest history
+            # messages get whatever room is left. Stored function calls are a single
+            # message along with their results, so those are never split up.
+            budget = self._token_limit - self._count_message_tokens(chat + [question])
+            start = self._fit_history(history, counts, budget)
+        for group in history[start:]:
+            chat.extend(group)
+        chat.append(question)
+        return chat
+
+    def _cache_key(self, chat: List[Dict[str, Any]], functions) -> str:
+        """Hash everything that determines GPT's reply to a request."""
+        return hashlib.blake2b(
+            json.dumps(
+                [self._conversation_id, self._model, chat, functions], sort_keys=True
+            ).encode(),
+            digest_size=32,
+        ).hexdigest()
+
+    def _store_turn(
+        self,
+        messages: List[Tuple[str, str]],
+        seen_id: Optional[int],
+        cache_key: Optional[str],
+        result: Optional[Dict[str, Any]],
+    ) -> Tuple[int, bool]:
+        """
+        Store the turn's messages (and cache the result) in one go.
+
+        Returns what `_insert_messages()` does.
+        """
+        with self._db.write() as con:
+            stored = self._insert_messages(con, messages, seen_id)
+            if cache_key and result:
+                con.execute(_SQL_PRUNE_CACHE, (self._cache_ttl,))
+                con.execute(_SQL_CACHE_REPLY, (cache_key, json.dumps(result)))
+        return stored
+
+    async def _end_turn(
+        self,
+        message: str,
+        reply: Optional[Tuple[str, str]],
+        cache_key: Optional[str] = None,
+        result: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Store the turn's question and `(role, reply)` (if any), and update the summary.
+
+        If `cache_key` is given, `result` is added to the reply cache in the same
+        transaction.
+        """
+        messages = [("user", message)]
+        if reply:
+            messages.append(reply)
+        seen_id = self._seen_id if self._chat_cache is not None else None
+        last_id, up_to_date = await asyncio.to_thread(
+            self._store_turn, messages, seen_id, cache_key, result
+        )
+        self._remember_messages(messages, last_id, up_to_date)
+
+        if self._summarize and (not self._summary_task or self._summary_task.done()):
+            assert self._message_limit
+            evicted = self._unsummarized - (self._message_limit - 1)
+            # Summarize in batches, so that it doesn't cost an extra call every turn,
+            # and in the background, so that the reply isn't delayed.
+            if (
+                evicted >= self._message_limit
+                and self._unsummarized >= self._summary_retry_at
+            ):
+                self._summary_task = asyncio.create_task(self._update_summary())
+                self._summary_task.add_done_callback(self._summary_done)
+
+    async def ask(self, message: str, functions=None) -> dict[str, Any]:
+        """Ask ChatGPT a question."""
+        chat = await self._build_chat(message)
+
+        cache_key = None
+        result = None
+        if self._cache_replies:
+            cache_key = self._cache_key(chat, functions)
+            result = await asyncio.to_thread(self._get_cached_reply, cache_key)
+            if result is not None:
+                # It's already cached, no need to write it again.
+                cache_key = None
+
+        if result is None:
+            result = await self._complete(chat, functions)
+
+        reply: Optional[Tuple[str, str]] = None
+        if result["type"] == "function":
+            if self._record_tool_calls:
+                # Store the calls themselves, so that GPT knows what it did next time.
+                calls = [
+                    {
+                        "id": f"call_{uuid.uuid4().hex}",
+                        "name": name,
+                        "arguments": arguments,
+                    }
+                    for name, arguments in result["data"]
+                ]
+                reply = ("assistant_tool", json.dumps(calls))
+        else:
+            reply = ("assistant", result["data"])
+        await self._end_turn(message, reply, cache_key, result)
+        return result
+
+    async def ask_stream(self, message: str) -> AsyncIterator[str]:
+        """
+        Ask ChatGPT a question, and yield its reply as it's being generated.
+
+        The turn is stored once the whole reply has been received, so if you stop
+        iterating early, nothing is stored (and the request is closed). Like `ask()`,
+        the reply is stripped of surrounding whitespace. Function calling isn't
+        supported here.
+        """
+        chat = await self._build_chat(message)
+
+        cache_key = None
+        if self._cache_replies:
+            cache_key = self._cache_key(chat, None)
+            result = await asyncio.to_thread(self._get_cached_reply, cache_key)
+            if result is not None:
+                yield result["data"]
+                await self._end_turn(message, ("assistant", result["data"]))
+                return
+
+        stream = await self._openai.chat.completions.create(
+            model=self._model, messages=chat, stream=True
+        )
+        pieces: List[str] = []
+        # Whitespace is held back until more text follows it, so that the pieces add
+        # up to the stripped reply that gets stored.
+        pending = ""
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                text = pending + (chunk.choices[0].delta.content or "")
+                if not pieces:
+                    text = text.lstrip()
+                piece = text.rstrip()
+                pending = text[len(piece) :]
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+        finally:
+            # Don't leave the connection open if the caller stopped early.
+            await stream.close()
+
+        reply = "".join(pieces)
+        await self._end_turn(
+            message, ("assistant", reply), cache_key, {"type": "text", "data": reply}
+        )
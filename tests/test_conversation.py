@@ -0,0 +1,737 @@
+import asyncio
+import json
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import chatgpt_bot
+from chatgpt_bot import _Database
+from chatgpt_bot import _SCHEMA_VERSION
+from chatgpt_bot import _SQL_INSERT_MESSAGE
+from chatgpt_bot import Conversation
+
+
+class FakeStream:
+    """Stands in for the stream of chunks that `create(stream=True)` returns."""
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    async def __aiter__(self):
+        # Some chunks have no choices, e.g. the usage statistics.
+        yield SimpleNamespace(choices=[])
+        for piece in self.pieces:
+            delta = SimpleNamespace(content=piece, tool_calls=None)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeCompletions:
+    """Stands in for `AsyncOpenAI().chat.completions`, and records every request."""
+
+    def __init__(self):
+        self.requests = []
+        self.streams = []
+        self.fail_summaries = False
+        # The finish reason of function calls, which is "stop" if they're forced.
+        self.tool_calls_finish_reason = "tool_calls"
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        summarize = kwargs["messages"][0]["content"].startswith("Summarize")
+        if summarize and self.fail_summaries:
+            raise RuntimeError("Summarizing failed.")
+        if kwargs.get("stream"):
+            stream = FakeStream(["\n", " Hello", " there", "! ", "\n"])
+            self.streams.append(stream)
+            return stream
+        if kwargs.get("tools"):
+            tool_call = SimpleNamespace(
+                type="function",
+                id="call_1",
+                function=SimpleNamespace(name="turn_on", arguments='{"light": 1}'),
+            )
+            message = SimpleNamespace(content=None, tool_calls=[tool_call])
+            finish_reason = self.tool_calls_finish_reason
+        else:
+            content = f"reply {len(self.requests)}"
+            if summarize:
+                content = f"summary {len(self.requests)}"
+            message = SimpleNamespace(content=content, tool_calls=None)
+            finish_reason = "stop"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(finish_reason=finish_reason, message=message)]
+        )
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=FakeCompletions())
+
+    async def close(self):
+        pass
+
+
+def make_conversation(filename, **kwargs) -> Conversation:
+    conversation = Conversation(
+        "conversation", api_key="key", database_filename=str(filename), **kwargs
+    )
+    conversation._openai = FakeOpenAI()
+    return conversation
+
+
+def requests(conversation: Conversation):
+    return conversation._openai.chat.completions.requests
+
+
+def test_migrates_baseline_database(tmp_path):
+    filename = tmp_path / "database.sqlite3"
+    # The schema from before the database was versioned.
+    con = sqlite3.connect(filename)
+    con.executescript(
+        """
+        CREATE TABLE "Message" (
+          "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+          "timestamp" DATETIME NOT NULL,
+          "conversation_id" TEXT NOT NULL,
+          "role" TEXT NOT NULL,
+          "message" TEXT NOT NULL
+        );
+        CREATE TABLE "Metadata" (
+          "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+          "conversation_id" TEXT NOT NULL UNIQUE,
+          "metadata" BLOB NOT NULL
+        );
+        CREATE INDEX "idx_message__conversation_id" ON "Message" ("conversation_id");
+        CREATE INDEX "idx_metadata__conversation_id" ON "Metadata" ("conversation_id");
+        INSERT INTO "Message" ("timestamp", "conversation_id", "role", "message")
+        VALUES
+          (datetime('now'), 'conversation', 'user', 'Hello'),
+          (datetime('now'), 'conversation', 'assistant', 'Hi there');
+        INSERT INTO "Metadata" ("conversation_id", "metadata")
+        VALUES ('conversation', '{"name": "Stavros"}');
+        """
+    )
+    con.commit()
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+    con.close()
+
+    conversation = make_conversation(filename)
+    assert conversation.get_metadata() == {"name": "Stavros"}
+    asyncio.run(conversation.ask("How are you?"))
+    assert requests(conversation)[0]["messages"][1:] == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi there"},
+        {"role": "user", "content": "How are you?"},
+    ]
+    asyncio.run(conversation.close())
+
+    con = sqlite3.connect(filename)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == _SCHEMA_VERSION
+    indexes = {
+        name
+        for (name,) in con.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL"
+        )
+    }
+    assert indexes == {
+        "idx_message__conversation_id_timestamp",
+        "idx_cache__created_at",
+    }
+    assert con.execute('SELECT COUNT(*) FROM "Message"').fetchone()[0] == 4
+    con.close()
+
+    # Opening an up-to-date database leaves it alone.
+    conversation = make_conversation(filename)
+    assert conversation.get_metadata() == {"name": "Stavros"}
+    asyncio.run(conversation.close())
+
+
+@pytest.mark.parametrize("record_tool_calls", [False, True])
+def test_history_window_keeps_tool_calls_whole(tmp_path, record_tool_calls):
+    filename = tmp_path / "database.sqlite3"
+    conversation = make_conversation(
+        filename, message_limit=4, record_tool_calls=record_tool_calls
+    )
+
+    async def talk():
+        await conversation.ask("First")
+        result = await conversation.ask("Lights", functions=[{"type": "function"}])
+        assert result == {"type": "function", "data": [("turn_on", {"light": 1})]}
+        await conversation.ask("Third")
+
+    asyncio.run(talk())
+    messages = requests(conversation)[-1]["messages"]
+    # The last three stored messages, and the question.
+    if record_tool_calls:
+        [call] = messages[3]["tool_calls"]
+        assert call["function"] == {"name": "turn_on", "arguments": '{"light": 1}'}
+        assert messages[1:] == [
+            {"role": "assistant", "content": "reply 1"},
+            {"role": "user", "content": "Lights"},
+            {"role": "assistant", "content": None, "tool_calls": [call]},
+            {"role": "tool", "tool_call_id": call["id"], "content": "Ok, done."},
+            {"role": "user", "content": "Third"},
+        ]
+    else:
+        # Only the question is stored, without a made-up reply.
+        assert messages[1:] == [
+            {"role": "user", "content": "First"},
+            {"role": "assistant", "content": "reply 1"},
+            {"role": "user", "content": "Lights"},
+            {"role": "user", "content": "Third"},
+        ]
+
+    # The history kept in memory matches the one loaded from the database.
+    chat = asyncio.run(conversation._build_chat("Next"))
+    reopened = make_conversation(
+        filename, message_limit=4, record_tool_calls=record_tool_calls
+    )
+    assert asyncio.run(reopened._build_chat("Next")) == chat
+    # The oldest message in the window is the function call, with its result, or
+    # the question that led to it.
+    assert chat[1]["role"] == ("assistant" if record_tool_calls else "user")
+    assert chat[-3:] == [
+        {"role": "user", "content": "Third"},
+        {"role": "assistant", "content": "reply 3"},
+        {"role": "user", "content": "Next"},
+    ]
+    assert len(chat) == (6 if record_tool_calls else 5)
+    asyncio.run(conversation.close())
+    asyncio.run(reopened.close())
+
+
+def test_readers_dont_block_the_writer(tmp_path):
+    database = _Database(str(tmp_path / "database.sqlite3"), readers=2)
+    with database.read() as reader:
+        reader.execute("BEGIN")
+        assert reader.execute('SELECT COUNT(*) FROM "Message"').fetchone()[0] == 0
+        # The write goes through while the read transaction is open...
+        with database.write() as con:
+            con.execute(
+                _SQL_INSERT_MESSAGE,
+                ("2024-01-01 00:00:00", "conversation", "user", "Hi"),
+            )
+        # ...and the reader keeps seeing its snapshot until it's done.
+        assert reader.execute('SELECT COUNT(*) FROM "Message"').fetchone()[0] == 0
+        reader.execute("COMMIT")
+
+    with database.read() as reader:
+        assert reader.execute('SELECT COUNT(*) FROM "Message"').fetchone()[0] == 1
+
+    # No more than `readers` connections are ever opened, and they're reused.
+    lock = threading.Lock()
+    active = []
+
+    def read(_):
+        with database.read() as reader:
+            with lock:
+                active.append(reader)
+                concurrent = len(active)
+            reader.execute('SELECT COUNT(*) FROM "Message"').fetchone()
+            time.sleep(0.01)
+            with lock:
+                active.remove(reader)
+            return concurrent
+
+    with ThreadPoolExecutor(8) as executor:
+        assert max(executor.map(read, range(32))) <= 2
+    assert database._readers.qsize() <= 2
+    database.close()
+
+
+def test_in_memory_database():
+    conversation = make_conversation(":memory:")
+    conversation.add_messages([("user", "Hello"), ("assistant", "Hi there")])
+    conversation.set_metadata({"a": 1})
+    assert conversation.get_metadata() == {"a": 1}
+    assert asyncio.run(conversation.ask("How are you?")) == {
+        "type": "text",
+        "data": "reply 1",
+    }
+    # Reads go through the writer, so they see what it wrote.
+    assert conversation._get_messages()[-2:] == [
+        [{"role": "user", "content": "How are you?"}],
+        [{"role": "assistant", "content": "reply 1"}],
+    ]
+    assert conversation._db._readers.empty()
+    asyncio.run(conversation.close())
+
+
+def test_conversations_share_a_database(tmp_path):
+    filename = tmp_path / "database.sqlite3"
+    first = make_conversation(filename)
+    second = make_conversation(filename)
+    other = make_conversation(tmp_path / "other.sqlite3")
+    assert first._db is second._db
+    assert first._db is not other._db
+    # In-memory databases are all different.
+    in_memory = [make_conversation(":memory:") for _ in range(2)]
+    assert in_memory[0]._db is not in_memory[1]._db
+
+    # The database stays open until its last conversation closes.
+    database = first._db
+    asyncio.run(first.close())
+    second.add_messages([("user", "Hello")])
+    asyncio.run(second.close())
+    with pytest.raises(sqlite3.ProgrammingError):
+        database._writer.execute("SELECT 1")
+
+    # After that, it's opened again.
+    reopened = make_conversation(filename)
+    assert reopened._db is not database
+    assert reopened._get_messages() == [[{"role": "user", "content": "Hello"}]]
+    for conversation in [other, reopened, *in_memory]:
+        asyncio.run(conversation.close())
+
+
+def test_closing_closes_borrowed_readers(tmp_path):
+    database = _Database(str(tmp_path / "database.sqlite3"))
+    with database.read() as reader:
+        database.close()
+        # The reader still works until it's returned.
+        reader.execute('SELECT COUNT(*) FROM "Message"').fetchone()
+    with pytest.raises(sqlite3.ProgrammingError):
+        reader.execute("SELECT 1")
+
+
+def test_summary_is_updated_in_batches(tmp_path):
+    filename = tmp_path / "database.sqlite3"
+
+    def summary_requests(conversation):
+        return [
+            request
+            for request in requests(conversation)
+            if request["messages"][0]["content"].startswith("Summarize")
+        ]
+
+    async def talk(conversation, turns):
+        for turn in range(turns):
+            await conversation.ask(f"Question {turn}")
+            if conversation._summary_task:
+                await conversation._summary_task
+
+    async def main():
+        conversation = make_conversation(filename, message_limit=3, summarize=True)
+
+        # Two turns only evict two messages, which isn't a whole batch yet.
+        await talk(conversation, 2)
+        assert not summary_requests(conversation)
+
+        await talk(conversation, 1)
+        # Evicted messages are sent until they're summarized.
+        assert [m["content"] for m in requests(conversation)[2]["messages"][1:]] == [
+            "Question 0",
+            "reply 1",
+            "Question 1",
+            "reply 2",
+            "Question 0",
+        ]
+        [request] = summary_requests(conversation)
+        assert request["messages"][1]["content"] == (
+            "user: Question 0\nassistant: reply 1\nuser: Question 1\nassistant: reply 2"
+        )
+
+        # The summary is sent after the system prompt, and survives a restart.
+        chat = await conversation._build_chat("Next")
+        assert chat[1:] == [
+            {
+                "role": "system",
+                "content": "Summary of the earlier conversation: summary 4",
+            },
+            {"role": "user", "content": "Question 0"},
+            {"role": "assistant", "content": "reply 3"},
+            {"role": "user", "content": "Next"},
+        ]
+        await conversation.close()
+
+        reopened = make_conversation(filename, message_limit=3, summarize=True)
+        assert await reopened._build_chat("Next") == chat
+        assert reopened._unsummarized == conversation._unsummarized
+        await reopened.close()
+
+    asyncio.run(main())
+
+
+def test_failed_summaries_back_off(tmp_path, caplog):
+    conversation = make_conversation(
+        tmp_path / "database.sqlite3", message_limit=2, summarize=True
+    )
+    completions = conversation._openai.chat.completions
+    completions.fail_summaries = True
+    attempts = []
+
+    async def talk():
+        for turn in range(6):
+            await conversation.ask(f"Question {turn}")
+            if conversation._summary_task:
+                await asyncio.gather(conversation._summary_task, return_exceptions=True)
+            attempts.append(len(requests(conversation)) - turn - 1)
+            if turn == 2:
+                completions.fail_summaries = False
+        await conversation.close()
+
+    asyncio.run(talk())
+    # The first attempt is after two turns, then after one more, then two more. Once
+    # it works, batches are summarized as usual again.
+    assert attempts == [0, 1, 2, 2, 3, 4]
+    assert caplog.messages == ["Couldn't summarize conversation conversation."] * 2
+    # Messages are kept in the history while they wait, up to a limit.
+    [request] = [
+        request
+        for request in requests(conversation)
+        if request["messages"][-1]["content"] == "Question 4"
+    ]
+    assert len(request["messages"]) == 1 + 5 + 1
+    assert conversation._summary_failures == 0
+
+
+def test_reply_cache(tmp_path):
+    filename = tmp_path / "database.sqlite3"
+    # With no history, asking the same question makes the same request.
+    conversation = make_conversation(filename, message_limit=1, cache_replies=True)
+    first = asyncio.run(conversation.ask("Hello"))
+    assert asyncio.run(conversation.ask("Hello")) == first
+    assert len(requests(conversation)) == 1
+
+    # Function calls come back the way they went in.
+    functions = [{"type": "function"}]
+    first = asyncio.run(conversation.ask("Lights", functions=functions))
+    assert asyncio.run(conversation.ask("Lights", functions=functions)) == first
+    assert len(requests(conversation)) == 2
+
+    # Other conversations don't share the cache.
+    other = Conversation(
+        "other",
+        api_key="key",
+        database_filename=str(filename),
+        message_limit=1,
+        cache_replies=True,
+    )
+    other._openai = FakeOpenAI()
+    asyncio.run(other.ask("Hello"))
+    assert len(requests(other)) == 1
+    asyncio.run(other.close())
+
+    # Expired replies are asked for again.
+    with conversation._db.write() as con:
+        con.execute(
+            """UPDATE "Cache" SET "created_at" = datetime('now', '-25 hours')"""
+        )
+    asyncio.run(conversation.ask("Hello"))
+    assert len(requests(conversation)) == 3
+    asyncio.run(conversation.close())
+
+
+def test_token_limit_keeps_newest_messages(tmp_path):
+    conversation = make_conversation(
+        tmp_path / "database.sqlite3", system_prompt="System", token_limit=50
+    )
+    counted = []
+
+    def count_tokens(text):
+        counted.append(text)
+        return len(text.split())
+
+    conversation._count_tokens = count_tokens
+    conversation.add_messages(
+        [("user", f"Question {i}") for i in range(100)]
+        + [("assistant_tool", '[{"id": "call_1", "name": "f", "arguments": {}}]')]
+        + [("assistant", "The answer")]
+    )
+
+    # Every message costs its words, plus four.
+    chat = asyncio.run(conversation._build_chat("Next"))
+    assert chat == [
+        {"role": "system", "content": "System"},
+        {"role": "user", "content": "Question 98"},
+        {"role": "user", "content": "Question 99"},
+        {"role": "assistant", "content": None, "tool_calls": chat[3]["tool_calls"]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "Ok, done."},
+        {"role": "assistant", "content": "The answer"},
+        {"role": "user", "content": "Next"},
+    ]
+    # Only the messages that might fit were counted, and the tool calls were too.
+    assert len(counted) == 9
+    assert any("tool_calls" not in text and "call_1" in text for text in counted)
+
+    # The next turn reuses the counts of the history.
+    counted.clear()
+    asyncio.run(conversation._build_chat("Next"))
+    assert counted == ["System", "Next"]
+
+    # Function calls are dropped along with their results, and the prompt and the
+    # question are always sent.
+    for token_limit in range(60):
+        conversation._token_limit = token_limit
+        chat = asyncio.run(conversation._build_chat("Next"))
+        assert chat[0]["role"] == "system"
+        assert chat[1]["role"] != "tool"
+        assert chat[-1] == {"role": "user", "content": "Next"}
+    asyncio.run(conversation.close())
+
+
+def test_history_includes_other_writers(tmp_path):
+    filename = tmp_path / "database.sqlite3"
+    first = make_conversation(filename, message_limit=5)
+    second = make_conversation(filename, message_limit=5)
+    other = Conversation("other", api_key="key", database_filename=str(filename))
+    loads = []
+    load_history = first._load_history
+
+    def counting_load_history():
+        loads.append(1)
+        return load_history()
+
+    first._load_history = counting_load_history
+
+    async def talk():
+        await first.ask("One")
+        # Other conversations don't make the history reload.
+        other.add_messages([("user", "Elsewhere")])
+        await first.ask("Two")
+        assert len(loads) == 1
+        await second.ask("Three")
+        await first.ask("Four")
+        assert len(loads) == 2
+
+    asyncio.run(talk())
+    assert [m["content"] for m in requests(first)[-1]["messages"][1:]] == [
+        "Two",
+        "reply 2",
+        "Three",
+        "reply 1",
+        "Four",
+    ]
+    for conversation in (first, second, other):
+        asyncio.run(conversation.close())
+
+
+def test_history_includes_messages_stored_while_loading(tmp_path):
+    conversation = make_conversation(tmp_path / "database.sqlite3")
+    load_history = conversation._load_history
+
+    def racing_load_history():
+        history = load_history()
+        conversation.add_messages([("user", "Meanwhile")])
+        return history
+
+    conversation._load_history = racing_load_history
+
+    async def talk():
+        await conversation.ask("One")
+        conversation._load_history = load_history
+        await conversation.ask("Two")
+
+    asyncio.run(talk())
+    assert [m["content"] for m in requests(conversation)[-1]["messages"][1:]] == [
+        "Meanwhile",
+        "One",
+        "reply 1",
+        "Two",
+    ]
+    asyncio.run(conversation.close())
+
+
+@pytest.mark.parametrize("use_orjson", [False, True])
+def test_metadata_round_trips_like_json(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(chatgpt_bot, "orjson", None)
+    conversation = make_conversation(":memory:")
+    for metadata in [
+        {"name": "Stavros", "items": [1, 2.5, None, True]},
+        {"big": 2**70},
+        {"nan": math.nan, "inf": -math.inf},
+        {1: "one"},
+    ]:
+        conversation.set_metadata(metadata)
+        loaded = conversation.get_metadata()
+        assert json.dumps(loaded) == json.dumps(json.loads(json.dumps(metadata)))
+
+    # Whatever json can't serialize is rejected, with or without orjson.
+    for metadata in [{"now": datetime.now()}, SimpleNamespace()]:
+        with pytest.raises(TypeError):
+            conversation.set_metadata(metadata)
+    assert conversation.get_metadata() == {"1": "one"}
+    asyncio.run(conversation.close())
+
+
+def test_ask_stream(tmp_path):
+    # With no history, asking the same question makes the same request.
+    conversation = make_conversation(
+        tmp_path / "database.sqlite3", message_limit=1, cache_replies=True
+    )
+    completions = conversation._openai.chat.completions
+
+    def stored():
+        with conversation._db.read() as con:
+            return con.execute('SELECT role, message FROM "Message"').fetchall()
+
+    async def ask(message):
+        return [piece async for piece in conversation.ask_stream(message)]
+
+    # The pieces add up to the stripped reply, which is what's stored.
+    assert asyncio.run(ask("Hi")) == ["Hello", " there", "!"]
+    assert completions.streams[0].closed
+    assert stored() == [("user", "Hi"), ("assistant", "Hello there!")]
+
+    # The same question is answered from the cache, and stored again.
+    assert asyncio.run(ask("Hi")) == ["Hello there!"]
+    assert len(completions.streams) == 1
+    assert stored()[2:] == [("user", "Hi"), ("assistant", "Hello there!")]
+
+    # If the caller stops early, the request is closed and nothing is stored.
+    async def stop_early():
+        stream = conversation.ask_stream("Something else")
+        assert await stream.__anext__() == "Hello"
+        await stream.aclose()
+
+    asyncio.run(stop_early())
+    assert completions.streams[1].closed
+    assert len(stored()) == 4
+    asyncio.run(conversation.close())
+
+
+def test_token_counting_accepts_special_tokens(tmp_path, monkeypatch):
+    class FakeEncoding:
+        def encode(self, text):
+            if "<|endoftext|>" in text:
+                raise ValueError("Encountered text corresponding to a special token.")
+            return text.split()
+
+        def encode_ordinary(self, text):
+            return text.split()
+
+    def encoding_for_model(model):
+        raise KeyError(model)
+
+    tiktoken = SimpleNamespace(
+        encoding_for_model=encoding_for_model, get_encoding=lambda name: FakeEncoding()
+    )
+    monkeypatch.setitem(sys.modules, "tiktoken", tiktoken)
+    conversation = make_conversation(tmp_path / "database.sqlite3", token_limit=100)
+    assert asyncio.run(conversation.ask("What does <|endoftext|> mean?")) == {
+        "type": "text",
+        "data": "reply 1",
+    }
+    assert conversation._count_tokens("What does <|endoftext|> mean?") == 4
+    asyncio.run(conversation.close())
+
+
+def test_forced_function_calls(tmp_path):
+    conversation = make_conversation(tmp_path / "database.sqlite3")
+    conversation._openai.chat.completions.tool_calls_finish_reason = "stop"
+    functions = [{"type": "function"}]
+    assert asyncio.run(conversation.ask("Lights", functions=functions)) == {
+        "type": "function",
+        "data": [("turn_on", {"light": 1})],
+    }
+
+    # A reply with no content at all is an empty one.
+    async def create(**kwargs):
+        message = SimpleNamespace(content=None, tool_calls=None)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(finish_reason="stop", message=message)]
+        )
+
+    conversation._openai.chat.completions.create = create
+    assert asyncio.run(conversation.ask("Hello")) == {"type": "text", "data": ""}
+    asyncio.run(conversation.close())
+
+    # The same goes for summaries.
+    conversation = make_conversation(
+        tmp_path / "database.sqlite3", message_limit=2, summarize=True
+    )
+    conversation._openai.chat.completions.create = create
+
+    async def talk():
+        for turn in range(2):
+            await conversation.ask(f"Question {turn}")
+        await conversation._summary_task
+        await conversation.close()
+
+    asyncio.run(talk())
+    assert conversation._summary_failures == 0
+
+
+def test_time_limit(tmp_path):
+    # Quotes in the ID can't break out of the query.
+    conversation_id = "it's \"quoted\"; --"
+    conversation = Conversation(
+        conversation_id,
+        api_key="key",
+        database_filename=str(tmp_path / "database.sqlite3"),
+        message_limit=3,
+        time_limit=2,
+    )
+    with conversation._db.write() as con:
+        con.executemany(
+            _SQL_INSERT_MESSAGE,
+            [
+                ("2000-01-01 00:00:00", conversation_id, "user", "Too old"),
+                ("2000-01-01 00:00:00", conversation_id, "assistant", "Way too old"),
+            ],
+        )
+        con.execute(
+            """
+            INSERT INTO "Message" (timestamp, conversation_id, role, message)
+            VALUES (datetime('now', '-1 hours'), ?, 'user', 'Recent')
+            """,
+            (conversation_id,),
+        )
+    assert conversation._get_messages() == [[{"role": "user", "content": "Recent"}]]
+
+    # The message limit still applies.
+    conversation.add_messages([("assistant", "One"), ("user", "Two")])
+    assert [group[0]["content"] for group in conversation._get_messages()] == [
+        "One",
+        "Two",
+    ]
+    asyncio.run(conversation.close())
+
+
+def test_timestamps_match_sqlite(tmp_path):
+    conversation = make_conversation(tmp_path / "database.sqlite3", time_limit=1)
+    conversation.add_messages([("user", "Hello")])
+    with conversation._db.read() as con:
+        stored, now = con.execute(
+            "SELECT timestamp, datetime('now') FROM Message"
+        ).fetchone()
+    # Timestamps are in UTC and in SQLite's format, so they compare as strings.
+    assert re.fullmatch(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d", stored)
+    difference = datetime.fromisoformat(now) - datetime.fromisoformat(stored)
+    assert timedelta(0) <= difference < timedelta(seconds=5)
+    assert conversation._get_messages() == [[{"role": "user", "content": "Hello"}]]
+    asyncio.run(conversation.close())
+
+
+def test_openai_is_imported_lazily(tmp_path):
+    # In a separate interpreter, so that nothing else has imported it already.
+    code = f"""
+import asyncio, sys
+from chatgpt_bot import Conversation
+
+conversation = Conversation("id", "key", database_filename={str(tmp_path / "db")!r})
+conversation.set_metadata({{"a": 1}})
+conversation.add_messages([("user", "Hello")])
+asyncio.run(conversation.close())
+assert "openai" not in sys.modules
+"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=root)